@@ -4,7 +4,10 @@ import asyncio
 import osmnx as ox
 import subprocess
 import sys
-import unidecode
+import math
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from xml.sax.saxutils import XMLGenerator
 from agents import set_tracing_export_api_key, Runner, function_tool, Agent
 #from IPython.display import Markdown, display
 from dotenv import load_dotenv
@@ -15,6 +18,121 @@ load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 set_tracing_export_api_key(api_key)
 
+# 2. Directorio donde se guardan los .osm descargados (caché en disco)
+OSM_CACHE_DIR = os.getenv("OSM_GRAPH_CACHE_DIR", ".")
+os.makedirs(OSM_CACHE_DIR, exist_ok=True)
+
+# 3. Caché de respuestas Overpass de OSMnx, persistente entre sesiones
+ox.settings.use_cache = True
+ox.settings.cache_folder = os.path.join(OSM_CACHE_DIR, "cache")
+
+# Plegado a ASCII de los caracteres habituales en topónimos (para nombres de archivo).
+# Las comas y puntos y coma se eliminan: netconvert interpreta --osm-files
+# como una lista separada por comas ("Pamplona, Navarra" -> pamplona_navarra)
+_ASCII_FOLD = str.maketrans(
+    "áéíóúàèìòùñüçÁÉÍÓÚÀÈÌÒÙÑÜÇ ",
+    "aeiouaeiounucAEIOUAEIOUNUC_",
+    ",;"
+)
+
+# Caché en memoria: lugar normalizado -> archivo .osm ya generado
+_GRAPH_CACHE: dict[str, str] = {}
+_GRAPH_LOCKS: dict[str, asyncio.Lock] = {}
+
+# 4. Rutas a las herramientas de SUMO dentro del venv (Windows)
+_SUMO_TOOLS = os.path.join(sys.prefix, "Lib", "site-packages", "sumo", "tools")
+_OSM_BUILD = os.path.join(_SUMO_TOOLS, "osmBuild.py")
+_RANDOM_TRIPS = os.path.join(_SUMO_TOOLS, "randomTrips.py")
+for _script in (_OSM_BUILD, _RANDOM_TRIPS):
+    if not os.path.exists(_script):
+        raise FileNotFoundError(
+            f"No se encontró '{_script}'. ¿Está instalado eclipse-sumo en el venv?"
+        )
+
+
+# -----------------------------------------------------------
+# Escritura incremental del grafo como OSM XML
+# -----------------------------------------------------------
+def _write_osm_element(xml, name, attrs, tags, nds=()):
+    """
+    Escribe un elemento <node>/<way> con sus <nd> y <tag>.
+    """
+    xml.startElement(name, attrs)
+    for node in nds:
+        xml.startElement("nd", {"ref": str(node)})
+        xml.endElement("nd")
+    for k, v in tags.items():
+        xml.startElement("tag", {"k": k, "v": str(v)})
+        xml.endElement("tag")
+    xml.endElement(name)
+    xml.ignorableWhitespace("\n")
+
+
+def _way_chains(edges):
+    """
+    Reconstruye la secuencia ordenada de nodos de una vía OSM a partir de
+    sus aristas (u, v). Devuelve una lista de cadenas de nodos.
+    """
+    successors = dict(edges)
+    targets = set(successors.values())
+    starts = [u for u in successors if u not in targets]
+    chains = []
+    for start in starts or [next(iter(successors))]:
+        chain = [start]
+        while chain[-1] in successors and len(chain) <= len(edges):
+            chain.append(successors.pop(chain[-1]))
+        chains.append(chain)
+    return chains
+
+
+def _save_osm_streaming(G, filename):
+    """
+    Guarda un grafo OSMnx sin simplificar como .osm escribiendo cada
+    <node> y <way> según se recorre, sin construir el árbol XML en memoria.
+    """
+    # Agrupar las aristas en sentido directo por vía OSM de origen
+    ways = defaultdict(list)
+    way_tags = {}
+    for u, v, data in G.edges(data=True):
+        if data.get("reversed"):
+            continue
+        ways[data["osmid"]].append((u, v))
+        if data["osmid"] not in way_tags:
+            tags = {t: data[t] for t in ox.settings.useful_tags_way if t in data}
+            tags["oneway"] = "yes" if data.get("oneway") else "no"
+            way_tags[data["osmid"]] = tags
+
+    # Escribir a un temporal para no dejar un .osm a medias en la caché
+    partial = filename + ".part"
+    try:
+        with open(partial, "w", encoding="utf-8") as f:
+            xml = XMLGenerator(f, encoding="utf-8", short_empty_elements=True)
+            xml.startDocument()
+            xml.startElement("osm", {"version": "0.6", "generator": "OSMnx"})
+            xml.ignorableWhitespace("\n")
+
+            for node, data in G.nodes(data=True):
+                tags = {t: data[t] for t in ox.settings.useful_tags_node if t in data}
+                attrs = {"id": str(node), "lat": str(data["y"]), "lon": str(data["x"])}
+                _write_osm_element(xml, "node", attrs, tags)
+
+            # Las vías partidas (p. ej. recortadas por el límite) reciben ids negativos
+            extra_id = 0
+            for osmid, edges in ways.items():
+                for i, chain in enumerate(_way_chains(edges)):
+                    if i:
+                        extra_id -= 1
+                    way_id = osmid if not i else extra_id
+                    _write_osm_element(xml, "way", {"id": str(way_id)}, way_tags[osmid], chain)
+
+            xml.endElement("osm")
+            xml.endDocument()
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, filename)
+
 
 # -----------------------------------------------------------
 # 🔧 TOOL: descarga un grafo OSM sin simplificar usando OSMnx
@@ -23,21 +141,31 @@ set_tracing_export_api_key(api_key)
 async def download_osm_map(place_name: str) -> str:
     """
     Descarga el grafo OSM del municipio indicado usando OSMnx sin simplificar.
-    El resultado se guarda en un archivo .osm en el directorio actual.
+    El resultado se guarda en un archivo .osm en OSM_GRAPH_CACHE_DIR.
     """
     try:
         # Nombre de archivo seguro
-        filename = unidecode.unidecode(place_name.lower().replace(' ', '_')) + ".osm"
+        key = place_name.strip().translate(_ASCII_FOLD).lower()
+        if key in _GRAPH_CACHE:
+            return _GRAPH_CACHE[key]
+
+        async with _GRAPH_LOCKS.setdefault(key, asyncio.Lock()):
+            filename = os.path.join(OSM_CACHE_DIR, key + ".osm")
 
-        print(f"Descargando el grafo OSM de '{place_name}' usando OSMnx (sin simplificar)...")
+            # Si ya se descargó en una sesión anterior, reutilizarlo
+            if not os.path.exists(filename):
+                print(f"Descargando el grafo OSM de '{place_name}' usando OSMnx (sin simplificar)...")
 
-        # Descargar el grafo sin simplificar, solo vías transitables en coche
-        G = ox.graph_from_place(place_name, network_type='drive', simplify=False)
+                # Descargar el grafo sin simplificar, solo vías transitables en coche.
+                # La escritura a .osm necesita un grafo sin simplificar; la simplificación
+                # de geometría ya la hace netconvert (--geometry.remove en osmBuild.py).
+                G = ox.graph_from_place(place_name, network_type='drive', simplify=False)
 
-        # Guardar como archivo .osm
-        ox.save_graph_xml(G, filepath=filename)
+                # Guardar como archivo .osm
+                _save_osm_streaming(G, filename)
 
-        return filename
+            _GRAPH_CACHE[key] = filename
+            return filename
 
     except Exception as e:
         return f"Error durante la descarga: {str(e)}"
@@ -57,32 +185,61 @@ async def convert_osm_to_sumo(osm_file: str) -> str:
 
         output_file = os.path.splitext(osm_file)[0] + ".net.xml"
 
-        # Ruta a osmBuild.py en Windows dentro del venv
-        venv_path = sys.prefix  # apunta a ...\venv
-        osm_build_script = os.path.join(venv_path, "Lib", "site-packages", "sumo", "tools", "osmBuild.py")
-        if not os.path.exists(osm_build_script):
-            return f"No se encontró osmBuild.py en '{osm_build_script}'."
-
         # Ejecutar osmBuild.py mediante subprocess
-        cmd = ["python", osm_build_script, "--osm-file", osm_file]
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        cmd = ["python", _OSM_BUILD, "--osm-file", osm_file]
+        # La salida estándar no se usa; stderr se decodifica solo si hay error
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
 
         if result.returncode != 0:
-            return f"Error al convertir el OSM: {result.stderr}"
+            return f"Error al convertir el OSM: {result.stderr.decode('utf-8', errors='replace')}"
 
         return f"Archivo SUMO generado correctamente: '{output_file}'"
 
     except Exception as e:
         return f"Error durante la conversión: {str(e)}"
 
+# -----------------------------------------------------------
+# Tasa de inserción de la demanda
+# -----------------------------------------------------------
+# Mínimo de salidas por segundo permitidas con --binomial
+DEMAND_BINOMIAL_MIN = 4
+
+
+def _binomial_n(net_file: str, insertion_density: float) -> int:
+    """
+    Calcula el N de --binomial (máximo de salidas por segundo) a partir de
+    la tasa de inserción. Suma la longitud de los carriles no internos, igual
+    que randomTrips.py con --insertion-density, y deja margen sobre la tasa.
+    """
+    lane_m = 0.0
+    root = None
+    internal = False
+    for event, elem in ET.iterparse(net_file, events=("start", "end")):
+        if root is None:
+            root = elem
+        if elem.tag == "edge":
+            if event == "start":
+                internal = elem.get("function") == "internal"
+            else:
+                elem.clear()
+                root.clear()
+        elif elem.tag == "lane" and event == "end" and not internal:
+            lane_m += float(elem.get("length", 0))
+
+    rate = insertion_density * lane_m / 1000 / 3600  # vehículos/s
+    return max(DEMAND_BINOMIAL_MIN, math.ceil(2 * rate))
+
+
 # -----------------------------------------------------------
 # 🔧 TOOL 3: genera demanda SUMO usando randomTrips.py
 # -----------------------------------------------------------
 @function_tool
-async def generate_sumo_demand(net_file: str, duration: int = 3600, period: float = 1.0) -> str:
+async def generate_sumo_demand(net_file: str, duration: int = 3600, insertion_density: float = 15.0) -> str:
     """
     Genera una demanda de tráfico para SUMO usando randomTrips.py
     a partir de una red .net.xml existente.
+    El número de vehículos escala con la longitud de la red
+    (insertion_density en vehículos/hora/km de vía).
     """
     try:
         if not os.path.exists(net_file):
@@ -92,43 +249,32 @@ async def generate_sumo_demand(net_file: str, duration: int = 3600, period: floa
         trips_file = base_name + ".trips.xml"
         routes_file = base_name + ".rou.xml"
 
-        # Ruta a randomTrips.py dentro del venv (Windows)
-        venv_path = sys.prefix
-        random_trips_script = os.path.join(
-            venv_path,
-            "Lib",
-            "site-packages",
-            "sumo",
-            "tools",
-            "randomTrips.py"
-        )
-
-        if not os.path.exists(random_trips_script):
-            return f"No se encontró randomTrips.py en '{random_trips_script}'."
-
         print("Generando demanda de tráfico con randomTrips.py...")
+        binomial = _binomial_n(net_file, insertion_density)
 
         cmd = [
             "python",
-            random_trips_script,
+            _RANDOM_TRIPS,
             "-n", net_file,
             "-e", str(duration),
-            "-p", str(period),
+            "--insertion-density", str(insertion_density),
+            "--binomial", str(binomial),
             "--trip-attributes", 'departLane="best" departSpeed="max"',
             "--route-file", routes_file
         ]
 
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # La salida estándar no se usa; stderr se decodifica solo si hay error
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
 
         if result.returncode != 0:
-            return f"Error al generar la demanda: {result.stderr}"
+            return f"Error al generar la demanda: {result.stderr.decode('utf-8', errors='replace')}"
 
         return (
             "Demanda SUMO generada correctamente:\n"
             f"- Red: {net_file}\n"
             f"- Rutas: {routes_file}\n"
             f"- Duración: {duration}s\n"
-            f"- Periodo: {period}s"
+            f"- Densidad de inserción: {insertion_density} veh/h/km"
         )
 
     except Exception as e:
@@ -2,53 +2,349 @@
 
 import os
 import asyncio
-import subprocess
+import collections
+import concurrent.futures
+import contextlib
+import math
+import re
+import shutil
 import sys
-import unidecode
-import osmnx as ox
-
-from dotenv import load_dotenv
-from agents import (
-    set_tracing_export_api_key,
-    Runner,
-    function_tool,
-    Agent,
+import tempfile
+import xml.etree.ElementTree as ET
+
+from pydantic import BaseModel, Field
+
+# En Windows los procesos del pool se crean con "spawn" y vuelven a ejecutar
+# este script como "__mp_main__". Por eso a nivel de módulo solo hay imports
+# ligeros y definiciones: las dependencias pesadas (osmnx, agents, openai) y
+# la configuración con efectos (entorno, cliente HTTP, agentes, pool) se
+# cargan bajo demanda desde el proceso principal (ver setup()).
+
+# Herramientas de SUMO (osmBuild.py, randomTrips.py) dentro del venv
+_SUMO_TOOLS = os.path.join(sys.prefix, "Lib", "site-packages", "sumo", "tools")
+_OSM_BUILD = os.path.join(_SUMO_TOOLS, "osmBuild.py")
+_RANDOM_TRIPS = os.path.join(_SUMO_TOOLS, "randomTrips.py")
+for _script in (_OSM_BUILD, _RANDOM_TRIPS):
+    if not os.path.exists(_script):
+        raise FileNotFoundError(
+            f"No se encontró '{_script}'. ¿Está instalado eclipse-sumo en el venv?"
+        )
+sys.path.insert(0, _SUMO_TOOLS)
+
+# Directorio donde se guardan los .osm descargados (caché en disco);
+# se fija en setup() a partir de OSM_GRAPH_CACHE_DIR
+OSM_CACHE_DIR = "."
+
+# Cliente HTTP de OpenAI y orquestador, creados en setup()
+_HTTP = None
+orchestrator = None
+
+# Plegado a ASCII de los caracteres habituales en topónimos (para nombres de archivo).
+# Las comas y puntos y coma se eliminan: netconvert interpreta --osm-files
+# como una lista separada por comas ("Pamplona, Navarra" -> pamplona_navarra)
+_ASCII_FOLD = str.maketrans(
+    "áéíóúàèìòùñüçÁÉÍÓÚÀÈÌÒÙÑÜÇ ",
+    "aeiouaeiounucAEIOUAEIOUNUC_",
+    ",;"
+)
+
+# Caché en memoria: lugar normalizado -> archivo .osm ya generado
+_GRAPH_CACHE: dict[str, str] = {}
+_GRAPH_LOCKS: dict[str, asyncio.Lock] = {}
+
+# Un lock por red (ruta base sin extensiones): la conversión y la demanda de
+# un mismo lugar escriben en los mismos archivos y no pueden solaparse
+_SUMO_LOCKS: dict[str, asyncio.Lock] = {}
+
+
+def _sumo_lock(path: str) -> asyncio.Lock:
+    """
+    Devuelve el lock compartido por los archivos .osm/.net.xml de un lugar.
+    """
+    base = path
+    for ext in (".xml", ".net", ".osm"):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    return _SUMO_LOCKS.setdefault(os.path.abspath(base), asyncio.Lock())
+
+
+# Filtro de vías transitables en coche (equivalente a network_type="drive");
+# {access} se sustituye por ox.settings.default_access, como hace OSMnx
+DRIVE_WAY_FILTER = (
+    '["highway"]["area"!~"yes"]{access}'
+    '["highway"!~"abandoned|bridleway|bus_guideway|construction|corridor|'
+    'cycleway|elevator|escalator|footway|no|path|pedestrian|planned|platform|'
+    'proposed|raceway|razed|service|steps|track"]'
+    '["motor_vehicle"!~"no"]["motorcar"!~"no"]'
+    '["service"!~"alley|driveway|emergency_access|parking|parking_aisle|private"]'
 )
 
 # =========================================================
-# ENV
+# Ejecución de scripts de SUMO en un pool de procesos
 # =========================================================
-load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY")
-set_tracing_export_api_key(api_key)
+# osmBuild.py y randomTrips.py son CPU-bound: varias ciudades en paralelo
+# se reparten entre núcleos en lugar de competir por el GIL.
+_POOL: concurrent.futures.ProcessPoolExecutor | None = None
+
+
+def _pool() -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Devuelve el pool de procesos, creándolo en el primer uso. Se deja el
+    número de procesos por defecto, que ya está limitado en Windows.
+    """
+    global _POOL
+    if _POOL is None:
+        _POOL = concurrent.futures.ProcessPoolExecutor()
+    return _POOL
+
+
+# Últimos bytes de la salida de un script de SUMO que se incluyen en el error
+SUMO_LOG_TAIL_BYTES = 4096
+
+
+@contextlib.contextmanager
+def _captured_output():
+    """
+    Redirige stdout/stderr del proceso del pool a un archivo temporal, a
+    nivel de descriptor, para capturar también la salida de netconvert y
+    duarouter. Cada proceso del pool ejecuta una sola tarea a la vez.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2))
+    with tempfile.TemporaryFile() as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield log
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+
+def _log_tail(log) -> str:
+    """
+    Devuelve el final de la salida capturada por _captured_output().
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log.seek(max(0, log.seek(0, os.SEEK_END) - SUMO_LOG_TAIL_BYTES))
+    return log.read().decode("utf-8", errors="replace").strip()
+
+
+def _run_osmbuild(args: list[str]) -> None:
+    """
+    Ejecuta osmBuild.py en un proceso del pool, sin volcar su salida en el REPL.
+    Lanza RuntimeError con el final de la salida si el script termina con error.
+    """
+    import osmBuild
+
+    with _captured_output() as log:
+        try:
+            osmBuild.build(args)
+        except SystemExit as e:
+            if e.code:
+                raise RuntimeError(
+                    f"osmBuild.py terminó con error: {e.code}\n{_log_tail(log)}"
+                ) from e
+
+
+def _run_randomtrips(args: list[str]) -> None:
+    """
+    Ejecuta randomTrips.py en un proceso del pool, sin volcar su salida en el REPL.
+    Lanza RuntimeError con el final de la salida si el script termina con error
+    o si main() devuelve False (p. ej. red sin aristas válidas).
+    """
+    import randomTrips
+
+    with _captured_output() as log:
+        try:
+            ok = randomTrips.main(randomTrips.get_options(args))
+        except SystemExit as e:
+            if e.code:
+                raise RuntimeError(
+                    f"randomTrips.py terminó con error: {e.code}\n{_log_tail(log)}"
+                ) from e
+            ok = True
+        # randomTrips.main() devuelve False si no puede generar viajes; su
+        # __main__ lo convierte en sys.exit(1), que aquí no llega a ocurrir
+        if ok is False:
+            raise RuntimeError(f"randomTrips.py no pudo generar viajes:\n{_log_tail(log)}")
+
+
+# Duración mínima (s) de cada subintervalo de demanda generado en paralelo
+DEMAND_MIN_CHUNK = 300
+
+# Mínimo de salidas por segundo permitidas con --binomial
+DEMAND_BINOMIAL_MIN = 4
+
+
+def _binomial_n(net_file: str, insertion_density: float) -> int:
+    """
+    Calcula el N de --binomial (máximo de salidas por segundo) a partir de
+    la tasa de inserción. Suma la longitud de los carriles no internos, igual
+    que randomTrips.py con --insertion-density, y deja margen sobre la tasa.
+    """
+    lane_m = 0.0
+    root = None
+    internal = False
+    for event, elem in ET.iterparse(net_file, events=("start", "end")):
+        if root is None:
+            root = elem
+        if elem.tag == "edge":
+            if event == "start":
+                internal = elem.get("function") == "internal"
+            else:
+                elem.clear()
+                root.clear()
+        elif elem.tag == "lane" and event == "end" and not internal:
+            lane_m += float(elem.get("length", 0))
+
+    rate = insertion_density * lane_m / 1000 / 3600  # vehículos/s
+    return max(DEMAND_BINOMIAL_MIN, math.ceil(2 * rate))
+
+_ROUTES_HEADER = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<routes xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    b'xsi:noNamespaceSchemaLocation="http://sumo.dlr.de/xsd/routes_file.xsd">\n'
+)
+
+
+def _merge_route_files(parts: list[str], routes_file: str) -> None:
+    """
+    Concatena los elementos de primer nivel de varios .rou.xml en uno,
+    leyéndolos en streaming. Los vType repetidos se escriben una sola vez.
+    """
+    seen_vtypes = set()
+    with open(routes_file, "wb") as out:
+        out.write(_ROUTES_HEADER)
+        for part in parts:
+            depth = 0
+            root = None
+            for event, elem in ET.iterparse(part, events=("start", "end")):
+                if event == "start":
+                    if root is None:
+                        root = elem
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                if elem.tag == "vType":
+                    duplicated = elem.get("id") in seen_vtypes
+                    seen_vtypes.add(elem.get("id"))
+                else:
+                    duplicated = False
+                if not duplicated:
+                    out.write(ET.tostring(elem))
+                # Soltar lo ya escrito: la raíz no debe acumular los hijos
+                root.clear()
+        out.write(b"</routes>\n")
+
+
+# =========================================================
+# Descarga directa de XML desde Overpass
+# =========================================================
+# Bytes finales del XML en los que buscar el <remark> de error de Overpass
+OVERPASS_TAIL_BYTES = 4096
+
+
+def _overpass_query(place_name: str) -> str:
+    """
+    Construye la consulta Overpass QL con las vías transitables en coche
+    dentro del límite administrativo del lugar.
+    """
+    import osmnx as ox
+
+    geometry = ox.geocode_to_gdf(place_name).geometry.iloc[0]
+    polygons = getattr(geometry, "geoms", [geometry])
+
+    way_filter = DRIVE_WAY_FILTER.format(access=ox.settings.default_access)
+    ways = "".join(
+        f'way{way_filter}(poly:"'
+        + " ".join(f"{lat} {lon}" for lon, lat in polygon.exterior.coords)
+        + '");'
+        for polygon in polygons
+    )
+    return f"[out:xml][timeout:{ox.settings.requests_timeout}];({ways});(._;>;);out body;"
+
+
+def _download_osm_xml(place_name: str, filename: str) -> None:
+    """
+    Descarga el XML de Overpass y lo escribe en disco tal cual, sin
+    construir ningún grafo intermedio.
+    """
+    import osmnx as ox
+    import requests
+
+    response = requests.post(
+        f"{ox.settings.overpass_url}/interpreter",
+        data={"data": _overpass_query(place_name)},
+        stream=True,
+        timeout=ox.settings.requests_timeout
+    )
+    response.raise_for_status()
+    response.raw.decode_content = True
+
+    # Escribir a un temporal para no dejar un .osm a medias en la caché
+    partial = filename + ".part"
+    try:
+        with open(partial, "wb") as f:
+            shutil.copyfileobj(response.raw, f)
+
+        # Overpass devuelve 200 con un <remark> y datos truncados si la
+        # consulta agota el tiempo o falla durante la ejecución
+        with open(partial, "rb") as f:
+            f.seek(max(0, os.path.getsize(partial) - OVERPASS_TAIL_BYTES))
+            tail = f.read()
+        if b"<remark>" in tail or b"</osm>" not in tail:
+            remark = tail.partition(b"<remark>")[2].partition(b"</remark>")[0]
+            raise RuntimeError(
+                "Respuesta de Overpass incompleta: "
+                + (remark.decode("utf-8", errors="replace").strip() or "sin </osm> final")
+            )
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, filename)
+
 
 # =========================================================
 # 🔧 TOOL 1: Descargar OSM
 # =========================================================
-@function_tool
 async def download_osm_map(place_name: str) -> str:
     """
-    Descarga un grafo OSM sin simplificar y lo guarda como .osm.
+    Descarga la red viaria OSM sin simplificar y la guarda como .osm.
     Devuelve SOLO el nombre del archivo generado.
     """
-    filename = unidecode.unidecode(place_name.lower().replace(" ", "_")) + ".osm"
-    print(f"📥 Descargando mapa OSM para: {place_name} ...")
+    key = place_name.strip().translate(_ASCII_FOLD).lower()
+    if key in _GRAPH_CACHE:
+        return _GRAPH_CACHE[key]
 
-    G = ox.graph_from_place(
-        place_name,
-        network_type="drive",
-        simplify=False
-    )
+    async with _GRAPH_LOCKS.setdefault(key, asyncio.Lock()):
+        filename = os.path.join(OSM_CACHE_DIR, key + ".osm")
+        if os.path.exists(filename):
+            print(f"♻️  Usando mapa OSM en caché: {filename}")
+            _GRAPH_CACHE[key] = filename
+            return filename
 
-    ox.save_graph_xml(G, filepath=filename)
-    print(f"✅ Archivo OSM generado: {filename}")
-    return filename
+        print(f"📥 Descargando mapa OSM para: {place_name} ...")
+
+        # La descarga es bloqueante: se ejecuta en un hilo para no parar el bucle
+        await asyncio.to_thread(_download_osm_xml, place_name, filename)
+        _GRAPH_CACHE[key] = filename
+        print(f"✅ Archivo OSM generado: {filename}")
+        return filename
 
 
 # =========================================================
 # 🔧 TOOL 2: Convertir OSM → SUMO (.net.xml)
 # =========================================================
-@function_tool
 async def convert_osm_to_sumo(osm_file: str) -> str:
     """
     Convierte un archivo .osm a red SUMO (.net.xml).
@@ -60,25 +356,16 @@ async def convert_osm_to_sumo(osm_file: str) -> str:
     base_name = os.path.splitext(osm_file)[0]
     output_net = base_name + ".net.xml"
 
-    venv_path = sys.prefix
-    osm_build_script = os.path.join(
-        venv_path, "Lib", "site-packages", "sumo", "tools", "osmBuild.py"
-    )
-    print(f"⚙️  Convirtiendo {osm_file} a red SUMO (.net.xml) ...")
-    subprocess.run(
-        [
-            "python",
-            osm_build_script,
-            "--osm-file", osm_file,
-            "--prefix", base_name
-        ],
-        check=True,
-        capture_output=True,
-        text=True
-    )
+    async with _sumo_lock(osm_file):
+        print(f"⚙️  Convirtiendo {osm_file} a red SUMO (.net.xml) ...")
+        await asyncio.get_running_loop().run_in_executor(
+            _pool(),
+            _run_osmbuild,
+            ["--osm-file", osm_file, "--prefix", base_name]
+        )
 
-    if not os.path.exists(output_net):
-        raise RuntimeError(f"No se generó el archivo esperado: {output_net}")
+        if not os.path.exists(output_net):
+            raise RuntimeError(f"No se generó el archivo esperado: {output_net}")
 
     print(f"✅ Archivo SUMO generado: {output_net}")
     return output_net
@@ -88,14 +375,15 @@ async def convert_osm_to_sumo(osm_file: str) -> str:
 # =========================================================
 # 🔧 TOOL 3: Generar demanda SUMO
 # =========================================================
-@function_tool
 async def generate_sumo_demand(
     net_file: str,
     duration: int = 1800,
-    period: float = 1.0
+    insertion_density: float = 15.0
 ) -> str:
     """
     Genera demanda SUMO con randomTrips.py.
+    El número de vehículos escala con la longitud de la red
+    (insertion_density en vehículos/hora/km de vía).
     Devuelve un mensaje resumen.
     """
     if not os.path.exists(net_file):
@@ -104,26 +392,48 @@ async def generate_sumo_demand(
     base = os.path.splitext(net_file)[0]
     routes_file = base + ".rou.xml"
 
-    venv_path = sys.prefix
-    random_trips_script = os.path.join(
-        venv_path, "Lib", "site-packages", "sumo", "tools", "randomTrips.py"
-    )
+    # randomTrips.py es secuencial: se reparte la duración en subintervalos
+    # que se generan en paralelo y después se concatenan en orden.
+    chunks = max(1, min(os.cpu_count() or 1, duration // DEMAND_MIN_CHUNK))
+    bounds = [duration * i // chunks for i in range(chunks + 1)]
+    parts = [f"{base}.{i}.rou.xml" for i in range(chunks)]
 
-    print(f"🚦 Generando demanda SUMO para {net_file} ...")
-    subprocess.run(
-        [
-            "python",
-            random_trips_script,
-            "-n", net_file,
-            "-e", str(duration),
-            "-p", str(period),
-            "--trip-attributes", 'departLane="best" departSpeed="max"',
-            "--route-file", routes_file,
-        ],
-        check=True,
-        capture_output=True,
-        text=True
-    )
+    async with _sumo_lock(net_file):
+        print(f"🚦 Generando demanda SUMO para {net_file} ({chunks} subintervalos) ...")
+        binomial = await asyncio.to_thread(_binomial_n, net_file, insertion_density)
+        loop = asyncio.get_running_loop()
+        try:
+            # Esperar a todos los subintervalos aunque alguno falle, para no
+            # borrar temporales que otro proceso del pool sigue escribiendo
+            results = await asyncio.gather(*(
+                loop.run_in_executor(
+                    _pool(),
+                    _run_randomtrips,
+                    [
+                        "-n", net_file,
+                        "-b", str(bounds[i]),
+                        "-e", str(bounds[i + 1]),
+                        "--insertion-density", str(insertion_density),
+                        "--binomial", str(binomial),
+                        "--seed", str(42 + i),
+                        "--prefix", f"{i}_",
+                        "--trip-attributes", 'departLane="best" departSpeed="max"',
+                        "-o", f"{base}.{i}.trips.xml",
+                        "--route-file", parts[i],
+                    ]
+                )
+                for i in range(chunks)
+            ), return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+
+            await asyncio.to_thread(_merge_route_files, parts, routes_file)
+        finally:
+            for i, part in enumerate(parts):
+                for tmp in (part, f"{base}.{i}.rou.alt.xml", f"{base}.{i}.trips.xml"):
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
 
     print(f"✅ Demanda generada: {routes_file}")
     return (
@@ -131,51 +441,30 @@ async def generate_sumo_demand(
         f"- Red: {net_file}\n"
         f"- Rutas: {routes_file}\n"
         f"- Duración: {duration}s\n"
-        f"- Periodo: {period}s"
+        f"- Densidad de inserción: {insertion_density} veh/h/km"
     )
 
 
 # =========================================================
-# 🤖 SUBAGENTE 1: Descarga OSM
+# 📋 ESQUEMA DE SALIDA DEL ORQUESTADOR
 # =========================================================
-osm_download_agent = Agent(
-    name="Agente Descargador OSM",
-    model="gpt-4.1-mini",
-    instructions=(
-        "Descarga mapas OSM usando OSMnx. "
-        "Recibes un nombre de lugar y devuelves "
-        "EXCLUSIVAMENTE el nombre del archivo .osm generado."
-    ),
-    tools=[download_osm_map],
-)
+class PipelineResult(BaseModel):
+    """
+    Archivos generados por el flujo OSM → SUMO → demanda.
+    """
+    osm_file: str = Field(description="Archivo .osm descargado")
+    net_file: str = Field(description="Red SUMO .net.xml generada")
+    routes_file: str = Field(description="Demanda SUMO .rou.xml generada")
+    summary: str = Field(description="Resumen breve del proceso")
 
-# =========================================================
-# 🤖 SUBAGENTE 2: Conversión a red SUMO
-# =========================================================
-sumo_net_agent = Agent(
-    name="Agente Conversor SUMO",
-    model="gpt-4.1-mini",
-    instructions=(
-        "Conviertes archivos .osm en redes SUMO (.net.xml) "
-        "usando osmBuild.py. "
-        "Recibes un archivo .osm y devuelves "
-        "EXCLUSIVAMENTE el nombre del archivo .net.xml."
-    ),
-    tools=[convert_osm_to_sumo],
-)
+    def __str__(self) -> str:
+        return (
+            f"{self.summary}\n"
+            f"- OSM: {self.osm_file}\n"
+            f"- Red: {self.net_file}\n"
+            f"- Rutas: {self.routes_file}"
+        )
 
-# =========================================================
-# 🤖 SUBAGENTE 3: Generación de demanda
-# =========================================================
-demand_agent = Agent(
-    name="Agente Generador de Demanda",
-    model="gpt-4.1-mini",
-    instructions=(
-        "Generas demanda de tráfico para SUMO usando randomTrips.py. "
-        "Recibes un archivo .net.xml y produces un archivo .rou.xml."
-    ),
-    tools=[generate_sumo_demand],
-)
 
 # =========================================================
 # 🧠 ORQUESTADOR
@@ -188,54 +477,232 @@ ORCHESTRATOR_PROMPT = (
     "2. Pasar el archivo OSM al agente de conversión SUMO\n"
     "3. Pasar la red SUMO al agente de generación de demanda\n\n"
     "No preguntes al usuario si desea continuar.\n"
-    "Al final, devuelve un resumen completo del proceso."
+    "Al final, devuelve los archivos generados en cada paso "
+    "y un resumen breve del proceso."
 )
 
-orchestrator = Agent(
-    name="Orquestador SUMO",
-    model="gpt-4.1",
-    instructions=ORCHESTRATOR_PROMPT,
-    tools=[
-        osm_download_agent.as_tool(
-            tool_name="download_osm",
-            tool_description="Descargar mapa OSM de un municipio"
+
+def build_orchestrator():
+    """
+    Construye los subagentes y el orquestador.
+    Solo se llama desde el proceso principal (ver setup()).
+    """
+    from agents import Agent, function_tool
+
+    # 🤖 SUBAGENTE 1: Descarga OSM
+    osm_download_agent = Agent(
+        name="Agente Descargador OSM",
+        model="gpt-4.1-mini",
+        instructions=(
+            "Descarga mapas OSM desde Overpass. "
+            "Recibes un nombre de lugar y devuelves "
+            "EXCLUSIVAMENTE el nombre del archivo .osm generado."
         ),
-        sumo_net_agent.as_tool(
-            tool_name="convert_to_sumo",
-            tool_description="Convertir OSM a red SUMO (.net.xml)"
+        tools=[function_tool(download_osm_map)],
+    )
+
+    # 🤖 SUBAGENTE 2: Conversión a red SUMO
+    sumo_net_agent = Agent(
+        name="Agente Conversor SUMO",
+        model="gpt-4.1-mini",
+        instructions=(
+            "Conviertes archivos .osm en redes SUMO (.net.xml) "
+            "usando osmBuild.py. "
+            "Recibes un archivo .osm y devuelves "
+            "EXCLUSIVAMENTE el nombre del archivo .net.xml."
         ),
-        demand_agent.as_tool(
-            tool_name="generate_demand",
-            tool_description="Generar demanda SUMO con randomTrips.py"
+        tools=[function_tool(convert_osm_to_sumo)],
+    )
+
+    # 🤖 SUBAGENTE 3: Generación de demanda
+    demand_agent = Agent(
+        name="Agente Generador de Demanda",
+        model="gpt-4.1-mini",
+        instructions=(
+            "Generas demanda de tráfico para SUMO usando randomTrips.py. "
+            "Recibes un archivo .net.xml y produces un archivo .rou.xml."
         ),
-    ],
-)
+        tools=[function_tool(generate_sumo_demand)],
+    )
+
+    return Agent(
+        name="Orquestador SUMO",
+        model="gpt-4.1-mini",
+        instructions=ORCHESTRATOR_PROMPT,
+        output_type=PipelineResult,
+        tools=[
+            osm_download_agent.as_tool(
+                tool_name="download_osm",
+                tool_description="Descargar mapa OSM de un municipio"
+            ),
+            sumo_net_agent.as_tool(
+                tool_name="convert_to_sumo",
+                tool_description="Convertir OSM a red SUMO (.net.xml)"
+            ),
+            demand_agent.as_tool(
+                tool_name="generate_demand",
+                tool_description="Generar demanda SUMO con randomTrips.py"
+            ),
+        ],
+    )
+
+
+# =========================================================
+# ⚙️ CONFIGURACIÓN DEL PROCESO PRINCIPAL
+# =========================================================
+def setup() -> None:
+    """
+    Carga el entorno, configura OSMnx y el cliente HTTP de OpenAI y
+    construye el orquestador. Solo se ejecuta en el proceso principal.
+    """
+    global OSM_CACHE_DIR, _HTTP, orchestrator
+
+    import httpx
+    import osmnx as ox
+    from dotenv import load_dotenv
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    from agents import set_default_openai_client, set_tracing_export_api_key
+
+    load_dotenv()
+    api_key = os.getenv("OPENAI_API_KEY")
+    set_tracing_export_api_key(api_key)
+
+    OSM_CACHE_DIR = os.getenv("OSM_GRAPH_CACHE_DIR", ".")
+    os.makedirs(OSM_CACHE_DIR, exist_ok=True)
+
+    # Caché de respuestas Overpass de OSMnx, persistente entre sesiones
+    ox.settings.use_cache = True
+    ox.settings.cache_folder = os.path.join(OSM_CACHE_DIR, "cache")
+
+    # Cliente HTTP persistente: reutiliza las conexiones TLS con OpenAI
+    # entre todas las llamadas de Runner.run durante la sesión del REPL
+    # (DefaultAsyncHttpxClient conserva el timeout por defecto del SDK de OpenAI)
+    _HTTP = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_keepalive_connections=20)
+    )
+    set_default_openai_client(AsyncOpenAI(api_key=api_key, http_client=_HTTP))
+
+    orchestrator = build_orchestrator()
+
 
 # =========================================================
 # 🚀 REPL INTERACTIVO
 # =========================================================
+# Peticiones del tipo "Descarga ... el mapa de <Lugar>[, <Provincia>] [y genera
+# demanda]": el flujo es fijo, así que se ejecuta directamente sin pasar por
+# el LLM. Cualquier otro matiz (duraciones, densidades, negaciones, varios
+# lugares...) se deja al orquestador.
+_PLACE_NAME = (
+    r"[A-ZÁÉÍÓÚÑ][\w'-]*"
+    r"(?:\s+(?:(?:de|del|la|las|los|el)\s+)*[A-ZÁÉÍÓÚÑ][\w'-]*)*"
+)
+_PIPELINE_RE = re.compile(
+    r"^(?i:descarga|procesa|simula)\b(?P<prefix>.*?)"
+    r"\b(?i:mapa|ciudad|municipio)\s+(?i:de)\s+"
+    rf"(?P<place>{_PLACE_NAME}(?:,\s*{_PLACE_NAME})?)"
+    r"(?:\s+(?i:y\s+(?:"
+    r"(?:genera|crea)(?:\s+(?:la|una))?\s+demanda(?:\s+de\s+tráfico)?"
+    r"|(?:lo\s+)?convierte\s+a\s+(?:(?:la\s+)?red\s+de\s+)?SUMO"
+    r")))*\s*\.?$"
+)
+_QUALIFIER_RE = re.compile(
+    r"\d|\b(?:no|sin|pero|salvo|excepto|durante|con|solo)\b",
+    re.IGNORECASE
+)
+
+
+async def run_pipeline(place_name: str) -> PipelineResult:
+    """
+    Ejecuta descarga → conversión → demanda sin intervención del LLM.
+    """
+    osm_file = await download_osm_map(place_name)
+    net_file = await convert_osm_to_sumo(osm_file)
+    summary = await generate_sumo_demand(net_file)
+    return PipelineResult(
+        osm_file=osm_file,
+        net_file=net_file,
+        routes_file=os.path.splitext(net_file)[0] + ".rou.xml",
+        summary=summary
+    )
+
+
+# Caché LRU de respuestas del orquestador por petición normalizada
+RESULT_CACHE_SIZE = 128
+_RESULT_CACHE: collections.OrderedDict[tuple[str, str], PipelineResult] = (
+    collections.OrderedDict()
+)
+
+
+async def run_prompt(prompt: str) -> PipelineResult:
+    """
+    Ejecuta una única petición y devuelve su salida.
+    Las peticiones repetidas se sirven desde la caché y las que siguen el
+    flujo estándar se ejecutan directamente; el resto pasa por el orquestador.
+    """
+    key = (orchestrator.name, prompt.strip().lower())
+    if key in _RESULT_CACHE:
+        _RESULT_CACHE.move_to_end(key)
+        return _RESULT_CACHE[key]
+
+    match = _PIPELINE_RE.match(prompt.strip())
+    if match and not _QUALIFIER_RE.search(match.group("prefix")):
+        output = await run_pipeline(match.group("place"))
+    else:
+        from agents import Runner
+
+        result = await Runner.run(
+            starting_agent=orchestrator,
+            input=prompt
+        )
+        output = result.final_output
+
+    _RESULT_CACHE[key] = output
+    if len(_RESULT_CACHE) > RESULT_CACHE_SIZE:
+        _RESULT_CACHE.popitem(last=False)
+    return output
+
+
 async def repl():
-    print("🤖 REPL Orquestador SUMO. Escribe 'exit' para salir.\n")
-    while True:
-        user_input = input("➡️  Tú: ").strip()
-        if user_input.lower() in ("exit", "quit"):
-            print("👋 Saliendo del REPL...")
-            break
-        if not user_input:
-            continue
+    print("🤖 REPL Orquestador SUMO. Escribe 'exit' para salir.")
+    print("   Separa varias peticiones con ';' para procesarlas en paralelo.")
+    print("   Escribe '/clear' para vaciar la caché de respuestas.\n")
+    try:
+        while True:
+            user_input = input("➡️  Tú: ").strip()
+            if user_input.lower() in ("exit", "quit"):
+                print("👋 Saliendo del REPL...")
+                break
+            if not user_input:
+                continue
+            if user_input.lower() == "/clear":
+                _RESULT_CACHE.clear()
+                print("🧹 Caché de respuestas vaciada.\n")
+                continue
 
-        try:
-            result = await Runner.run(
-                starting_agent=orchestrator,
-                input=user_input
+            # Las peticiones repetidas en el mismo lote se ejecutan una sola vez
+            prompts = list(dict.fromkeys(p.strip() for p in user_input.split(";") if p.strip()))
+            results = await asyncio.gather(
+                *(run_prompt(prompt) for prompt in prompts),
+                return_exceptions=True
             )
-            print("\n===== RESULTADO =====\n")
-            print(result.final_output)
-            print("\n====================\n")
-        except Exception as e:
-            print("🚨 Error durante la ejecución:")
-            print(e)
-            print("\n====================\n")
+
+            for prompt, output in zip(prompts, results):
+                if isinstance(output, Exception):
+                    print(f"🚨 Error durante la ejecución de '{prompt}':")
+                    print(output)
+                    print("\n====================\n")
+                    continue
+                print("\n===== RESULTADO =====\n")
+                print(output)
+                print("\n====================\n")
+    finally:
+        # Cerrar el cliente HTTP también con EOF, Ctrl+C o errores inesperados
+        await _HTTP.aclose()
 
 if __name__ == "__main__":
-    asyncio.run(repl())
+    setup()
+    try:
+        asyncio.run(repl())
+    finally:
+        if _POOL is not None:
+            _POOL.shutdown()